@@ -1,13 +1,79 @@
-from collections import Iterable
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from email.parser import HeaderParser
+from io import StringIO
+from pathlib import Path
+import hashlib
 import logging
+import mmap
 import os
+import re
 import subprocess
 import sys
 import site
 import json
+import threading
+import warnings
+
+try:
+    from importlib import metadata
+except ImportError:  # python < 3.8
+    import importlib_metadata as metadata
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __all__ = ("Mapper",)
 
+_SITE_PKGS = site.getsitepackages()[0]
+# run pip of the current interpreter, so all pip calls target the same environment
+_PIP = [sys.executable, "-m", "pip"]
+
+_NOT_FOUND_RE = re.compile(r"ERROR: (?:Could not find a version that satisfies the requirement"
+                           r"|No matching distribution found for) ([A-Za-z0-9_.\-]+)")
+_REQ_RE = re.compile(r"^\s*([A-Za-z0-9_.\-]+(?:\[[^\]]*\])?)\s*==\s*([^\s;#]+)")
+_CANONICAL_NAME_RE = re.compile(r"[-_.]+")
+_SHOW_SEPARATOR_RE = re.compile(r"^---$", re.MULTILINE)
+
+
+def _canonicalize_name(name: str) -> str:
+    """
+    Normalize package name as described in PEP 503, so "Foo.Bar", "foo_bar" and "foo-bar" are the same package.
+    Extras are dropped, so "requests[security]" is the "requests" package
+
+    :param name: package name
+    :return: str
+    """
+    return _CANONICAL_NAME_RE.sub("-", name.split("[", 1)[0]).lower()
+
+
+def _user_cache_dir() -> str:
+    """
+    Location of the pipmap cache directory for the current user
+
+    :return: str
+    """
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pipmap")
+
+
+def _cache_file(site_pkgs: str) -> str:
+    """
+    Location of the cache file for the current interpreter and site-packages.
+    Every environment has its own file, so environments used in turn do not evict each other
+
+    :param site_pkgs: site-packages location
+    :return: str
+    """
+    env = hashlib.sha1(f"{sys.prefix}\0{site_pkgs}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(_user_cache_dir(), f"meta-{env}.json")
+
 
 class Mapper:
     """
@@ -16,17 +82,20 @@ class Mapper:
     TODO add ability to get requirements from str, json(as list of requirements), or base64.
     """
 
-    def __init__(self, reqs="requirements.txt", fmt="json", debug=False) -> None:
+    __slots__ = ("_regs", "_fmt", "log", "_site_pkgs", "_verbose", "_pkgs_map", "_lock", "_site_index", "_cache_path")
+
+    def __init__(self, reqs="requirements.txt", fmt="json", debug=False, cache=True) -> None:
         self._regs = reqs
         self._fmt = fmt
         self.log = logging.getLogger("pipmap")
         if debug:
             logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-        self._site_pkgs = site.getsitepackages()[0]
-        if isinstance(self._site_pkgs, list):
-            self._site_pkgs = self._site_pkgs[0]
+        self._site_pkgs = _SITE_PKGS
         self._verbose = 'v'
         self._pkgs_map = {}
+        self._lock = threading.Lock()
+        self._site_index = {}
+        self._cache_path = _cache_file(self._site_pkgs) if cache else None
 
     def _cmd(self, cmd: list) -> tuple:
         """
@@ -35,109 +104,205 @@ class Mapper:
         :param cmd: list of cmd and args. Example: ["pip", "show", "requests"]
         :return: tuple(stdout, stderr)
         """
-        self.log.debug(f"Start to execute cmd: {cmd}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout = result.stdout.decode()
-        self.log.debug(f"cmd: {cmd}. stdout: {stdout}")
-        stderr = result.stderr.decode()
+        self.log.debug("Start to execute cmd: %s", cmd)
+        with self._popen(cmd) as proc:
+            stdout, stderr = proc.communicate()
+        self.log.debug("cmd: %s. stdout: %s", cmd, stdout)
         if stderr:
-            self.log.debug(f"cmd: {cmd}. stderr: {stderr}")
+            self.log.debug("cmd: %s. stderr: %s", cmd, stderr)
         return stdout, stderr
 
-    def _split(self, data: Iterable, delimiter: str = "==") -> any:
+    def _stream_cmd(self, cmd: list) -> tuple:
         """
-        Split list of lines by delimiter.
+        Method to execute command and log the stdout line by line without keeping it in memory
 
-        :param data: list of lines
-        :param delimiter: str to split line
-        :raise Exception: If data is not iterable will raise Exception
-        :return: dict
+        :param cmd: list of cmd and args. Example: ["pip", "install", "-r", "requirements.txt"]
+        :return: tuple(exit code, stderr)
+        """
+        self.log.debug("Start to execute cmd: %s", cmd)
+        with self._popen(cmd) as proc, ThreadPoolExecutor(max_workers=1) as executor:
+            # drain stderr in background, so the process never blocks on a full pipe
+            _stderr = executor.submit(proc.stderr.read)
+            _debug = self.log.isEnabledFor(logging.DEBUG)
+            for line in proc.stdout:
+                if _debug:
+                    self.log.debug("cmd: %s. stdout: %s", cmd, line.rstrip())
+            stderr = _stderr.result()
+        if stderr:
+            self.log.debug("cmd: %s. stderr: %s", cmd, stderr)
+        return proc.returncode, stderr
+
+    def _pip(self, args: list) -> tuple:
         """
-        if not hasattr(data, '__iter__'):
-            self.log.error(f"Data are not iterable instance: {data}")
-            raise Exception(f"Data are not iterable instance: {data}")
-        reqs = [r.strip().split(delimiter, 1) for r in data if r.find(delimiter) > -1]
-        return {key.strip(): value.strip() for (key, value) in reqs}
+        Run pip inside the current interpreter to skip starting a new one.
+        pip has no public python API, so fall back to pip subprocess if its internals are not usable
 
-    def _get_pkg_path(self, name: str, version: str) -> any:
+        :param args: list of pip args. Example: ["install", "-r", "requirements.txt"]
+        :return: tuple(exit code, stderr)
         """
-        This method finds the package info location.
-        Try to looking for in the site-packages location and with suffixes [.egg-info, .dist-info] directories
-        If any path not exists raise an Exception
+        try:
+            from pip._internal.cli.main import main as pip_main
+        except ImportError:
+            self.log.debug("pip is not importable, run it as a subprocess")
+            return self._stream_cmd([*_PIP, *args])
 
-        :param name: package name
-        :param version: package version
-        :raise Exception if the package location not found
-        :return: path of the package location
-        """
-        print(f"name: ${name}")
-        print(f"version: ${version}")
-        pkg_path_tmpl = "{name}-{version}.{suffix}-info"
-        suffixes = ["egg", "dist"]
-        for suf in suffixes:
-            _pkg_location = pkg_path_tmpl.format(name=name, version=version, suffix=suf)
-            _pkg_path = os.path.join(self._site_pkgs, _pkg_location)
-            _pkg_location2 = pkg_path_tmpl.format(name=name.replace("-", "_"), version=version, suffix=suf)
-            _pkg_path2 = os.path.join(self._site_pkgs, _pkg_location2)
-            self.log.debug(f"pkg:{name}:{version} check location {_pkg_path}")
-            if os.path.exists(_pkg_path):
-                return _pkg_path
-            elif os.path.exists(_pkg_path2):
-                return _pkg_path2
+        self.log.debug("Start to execute pip: %s", args)
+        # pip configures the root logger and warnings for its own output, restore them afterwards
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        showwarning = warnings.showwarning
+        stdout, stderr = StringIO(), StringIO()
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                code = pip_main(args)
+        except SystemExit as e:
+            # pip exits on invalid command line options
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            self.log.debug("pip failed in-process: %s. Run it as a subprocess", e)
+            return self._stream_cmd([*_PIP, *args])
+        finally:
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            warnings.showwarning = showwarning
+        err = stderr.getvalue()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("pip: %s. stdout: %s", args, stdout.getvalue())
+            if err:
+                self.log.debug("pip: %s. stderr: %s", args, err)
+        return code, err
 
-        else:
-            self.log.error(f"Package dir not found for {name}:{version}")
+    @staticmethod
+    def _popen(cmd: list) -> subprocess.Popen:
+        """
+        Start command with text stdout and stderr pipes
+
+        :param cmd: list of cmd and args
+        :return: subprocess.Popen
+        """
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                encoding="utf-8", errors="replace", bufsize=1)
 
-        return None
+    def _split(self, data: Iterable) -> any:
+        """
+        Split list of requirements lines to package name (with extras) and pinned version.
+        Lines without pinned version are skipped
+
+        :param data: list of lines
+        :return: dict
+        """
+        reqs = {}
+        for line in data:
+            m = _REQ_RE.match(line)
+            if m:
+                reqs[m.group(1)] = m.group(2)
+            elif line.strip() and not line.lstrip().startswith("#"):
+                self.log.warning("Requirement is not pinned with ==, skipped: %s", line.strip())
+        return reqs
+
+    def _read_text(self, path: str) -> str:
+        """
+        Read whole file from path at once
+
+        :param path: str
+        :raise FileNotFoundError: If file not exists in the path
+        :return: str
+        """
+        with open(path, 'rb', buffering=4096) as fin:
+            return fin.read().decode('utf-8', 'replace')
 
     def _read(self, path: str) -> any:
         """
         Read file from path and returns striped lines
 
         :param path: str
+        :raise FileNotFoundError: If file not exists in the path
         """
         # TODO validate path
-        self.log.debug(f"Start to read file: {path}")
-        if not os.path.exists(path):
-            self.log.error(f"File not found in the path: {path}")
-            raise Exception(f"File not found in the path: {path}")
-        with open(path, 'r') as fin:
-            lines = fin.readlines()
-            self.log.debug(f"Finished reading the file: {lines}")
+        self.log.debug("Start to read file: %s", path)
+        try:
+            lines = self._read_text(path).splitlines()
+        except FileNotFoundError:
+            raise FileNotFoundError(f"File not found in the path: {path}") from None
+        self.log.debug("Finished reading the file: %s", lines)
         return lines
 
-    def _install(self, name: str, version: str) -> tuple:
+    def _install(self, specs: list) -> set:
         """
-        Install package from requirements file with pip
+        Install all packages with a single pip run.
+        pip installs nothing if any requirement is not found, so run it again without the not found ones
 
-        :param name: str
-        :param version: str
-        :return: tuple
+        :param specs: list of requirements. Example: ["requests==2.23.0"]
+        :return: set of canonical package names pip failed to find
         """
-        res, err = self._cmd(["pip", "install", f"{name}=={version}"])
-        if err:
-            # TODO handle err
+        failed = set()
+        while specs:
+            code, err = self._pip(["install", *specs])
+            if not code:
+                break
+            self.log.error("Packages %s not installed: %s", specs, err)
+            _failed = {_canonicalize_name(name) for name in _NOT_FOUND_RE.findall(err)} - failed
+            if not _failed:
+                break
             # todo add to mapping as not installed
-            self.log.error(f"Package {name}:{version} not installed: {err}")
-        return res, err
+            failed |= _failed
+            specs = [spec for spec in specs if _canonicalize_name(spec.split("==", 1)[0]) not in failed]
+        return failed
+
+    def _index_site_pkgs(self) -> dict:
+        """
+        Scan the site-packages location once and collect all package info directories.
+        Directory names are "{name}-{version}.dist-info" or "{name}-{version}[-pyX.Y].egg-info"
+
+        :return: dict of (canonical package name, version) to the package info directory path
+        """
+        self.log.debug("Index site-packages location: %s", self._site_pkgs)
+        index = {}
+        with os.scandir(self._site_pkgs) as entries:
+            for entry in entries:
+                if not entry.name.endswith((".dist-info", ".egg-info")):
+                    continue
+                _name, _, _version = entry.name.rsplit(".", 1)[0].partition("-")
+                if _version:
+                    index[(_canonicalize_name(_name), _version.split("-", 1)[0])] = entry.path
+        return index
+
+    def _get_pkg_path(self, name: str, version: str) -> any:
+        """
+        This method finds the package info location in the site-packages index
+
+        :param name: package name
+        :param version: package version
+        :return: path of the package location or None if the package location not found
+        """
+        return self._site_index.get((_canonicalize_name(name), version))
 
     def _get_pkg_meta(self, location: str) -> any:
         """
-        Read package metadata from package location
+        Read package metadata headers from package location.
+        The file is memory mapped and only the headers part is parsed, long descriptions are never copied
 
         :param location:
         :return: dict
         """
-        self.log.debug(f"Get meta from location: {location}")
+        self.log.debug("Get meta from location: %s", location)
         _meta_file = "METADATA"
         if location.endswith("egg-info"):
             _meta_file = "PKG-INFO"
-        if not os.path.exists(os.path.join(location, _meta_file)):
-            self.log.warning(f"{_meta_file} not found in the {location}")
+        try:
+            with open(os.path.join(location, _meta_file), 'rb') as fin:
+                if os.fstat(fin.fileno()).st_size == 0:
+                    return {}
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # headers are separated from the description body with an empty line
+                    _end = mm.find(b"\n\n")
+                    _headers = mm[:_end + 1] if _end > -1 else mm[:]
+        except (FileNotFoundError, NotADirectoryError):
+            self.log.warning("%s not found in the %s", _meta_file, location)
             return None
-        _file_data = self._read(os.path.join(location, _meta_file))
-        _meta_data = self._split(_file_data, ":")
-        return _meta_data
+        # metadata is RFC 822 formatted, header parser handles folded values
+        # parse as text, so non-ASCII values come back as str instead of email.header.Header
+        return dict(HeaderParser().parsestr(_headers.decode("utf-8", "replace")).items())
 
     def _get_pkg_top_level(self, location: str) -> any:
         """
@@ -146,14 +311,14 @@ class Mapper:
         :param location:
         :return:
         """
-        self.log.debug("Get top level from location: {location}")
+        self.log.debug("Get top level from location: %s", location)
         _toplevel_file = "top_level.txt"
-        if not os.path.exists(os.path.join(location, _toplevel_file)):
-            self.log.warning(f"{_toplevel_file} not found in the {location}")
+        try:
+            _file_data = Path(location, _toplevel_file).read_text(encoding="utf-8")
+        except (FileNotFoundError, NotADirectoryError):
+            self.log.warning("%s not found in the %s", _toplevel_file, location)
             return None
-        _file_data = self._read(os.path.join(location, _toplevel_file))
-        _modules = [m.strip() for m in _file_data]
-        return _modules
+        return [m.strip() for m in _file_data.splitlines() if m.strip()]
 
     def _add_pkg_data(self, name: str, version: str) -> any:
         """
@@ -165,25 +330,140 @@ class Mapper:
         """
         _pkg_location = self._get_pkg_path(name, version)
         if _pkg_location is None:
+            self.log.error("Package dir not found for %s:%s", name, version)
             return
-        self.log.debug(f"pkg{name}:{version} | location: {_pkg_location}")
-        _pkg_meta = self._get_pkg_meta(_pkg_location)
-        self.log.debug(f"pkg{name}:{version} | meta: {_pkg_meta}")
-        _pkg_name = _pkg_meta.get("Name") or name
+        self.log.debug("pkg%s:%s | location: %s", name, version, _pkg_location)
+        _pkg_meta = self._get_pkg_meta(_pkg_location) or {}
+        self.log.debug("pkg%s:%s | meta: %s", name, version, _pkg_meta)
         _pkg_modules = self._get_pkg_top_level(_pkg_location)
-        self.log.debug(f"pkg{name}:{version} | _pkg_modules: {_pkg_modules}")
+        self.log.debug("pkg%s:%s | _pkg_modules: %s", name, version, _pkg_modules)
+        self._set_pkg_data(name, version, _pkg_meta, _pkg_modules)
+
+    def _add_dist_data(self, name: str, version: str) -> bool:
+        """
+        Update package installed outside of the site-packages location (e.g. user site) with detail information.
+        importlib.metadata searches all sys.path locations of the current interpreter
 
+        :param name: package name
+        :param version: package version
+        :return: True if the package with the same version is found
+        """
+        try:
+            _dist = metadata.distribution(_canonicalize_name(name))
+        except metadata.PackageNotFoundError:
+            return False
+        if _dist.version != version:
+            return False
+        _top_level = _dist.read_text("top_level.txt")
+        if _top_level is None:
+            self.log.warning("top_level.txt not found for %s:%s", name, version)
+            _pkg_modules = None
+        else:
+            _pkg_modules = [m.strip() for m in _top_level.splitlines() if m.strip()]
+        self._set_pkg_data(name, version, dict(_dist.metadata.items()), _pkg_modules)
+        return True
+
+    def _batch_show(self, names: list) -> dict:
+        """
+        Get packages metadata from pip in one run. Used for packages not found by importlib.metadata
+
+        :param names: list of package names
+        :return: dict of canonical package name to its metadata
+        """
+        stdout, _ = self._cmd([*_PIP, "show", *names])
+        metas = {}
+        for stanza in _SHOW_SEPARATOR_RE.split(stdout):
+            _meta = dict(HeaderParser().parsestr(stanza.strip()).items())
+            if _meta.get("Name"):
+                metas[_canonicalize_name(_meta["Name"])] = _meta
+        return metas
+
+    def _set_pkg_data(self, name: str, version: str, meta: dict, modules: any) -> None:
+        """
+        Store package details to the packages map
+
+        :param name: package name from requirements
+        :param version: package version from requirements
+        :param meta: package metadata
+        :param modules: list of package top level modules
+        """
+        _pkg_name = meta.get("Name") or name
         # collect package by metadata name
         # collect raw str from requirements as the name can be different
-        self._pkgs_map[_pkg_name] = {
-            # all details
-            "metadata": _pkg_meta,
-            "requirements": {
-                "name": name,
-                "version": version,
-                "raw": f"{name}=={version}"
-            },
-            "top_level": _pkg_modules
+        with self._lock:
+            self._pkgs_map[_pkg_name] = {
+                # all details
+                "metadata": meta,
+                "requirements": {
+                    "name": name,
+                    "version": version,
+                    "raw": f"{name}=={version}"
+                },
+                "top_level": modules
+            }
+
+    def _cache_key(self) -> list:
+        """
+        Key of the cached packages data. Any package install or removal changes the site-packages mtime
+
+        :return: list of interpreter prefix and site-packages mtime
+        """
+        return [sys.prefix, os.stat(self._site_pkgs).st_mtime_ns]
+
+    def _load_cache(self) -> dict:
+        """
+        Read cached packages data stored for the current site-packages state
+
+        :return: dict of raw requirement to the package name and its data
+        """
+        if self._cache_path is None:
+            return {}
+        try:
+            with open(self._cache_path, 'r') as fin:
+                cache = json.load(fin)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("key") != self._cache_key():
+            self.log.debug("Cache is outdated: %s", self._cache_path)
+            return {}
+        return cache.get("pkgs", {})
+
+    def _save_cache(self, pkgs: dict) -> None:
+        """
+        Store packages data for the current site-packages state
+
+        :param pkgs: dict of raw requirement to the package name and its data
+        """
+        if self._cache_path is None:
+            return
+        cache = {"key": self._cache_key(), "pkgs": {**self._load_cache(), **pkgs}}
+        try:
+            # serialize before opening the file, so a failure does not leave a partial file behind
+            _data = json.dumps(cache)
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            _tmp_path = f"{self._cache_path}.{os.getpid()}.tmp"
+            with open(_tmp_path, 'w') as fout:
+                fout.write(_data)
+            os.replace(_tmp_path, self._cache_path)
+        except (OSError, TypeError, ValueError) as e:
+            self.log.warning("Cache not saved to %s: %s", self._cache_path, e)
+
+    @staticmethod
+    def _pkg_info(pkg: str, data: dict) -> dict:
+        """
+        Short package info for the output
+
+        :param pkg: package name
+        :param data: package details
+        :return: dict
+        """
+        # packages map is filled by _set_pkg_data, so all keys are always present
+        _reqs_name = data["requirements"]["name"]
+        return {
+            "name": pkg,
+            "version": data["metadata"].get("Version", "UNKNOWN"),
+            "modules": data["top_level"] or [],
+            "alias": _reqs_name if _reqs_name != pkg else ""
         }
 
     def _format(self) -> any:
@@ -218,21 +498,14 @@ class Mapper:
         # todo add package detail level as --verbose[v, vv]
         pkgs_info = []
         if self._verbose == 'v':
-            for pkg, data in self._pkgs_map.items():
-                _reqs_name = data.get("requirements", {}).get("name")
-                _pkg = {
-                    "name": pkg,
-                    "version": data.get("metadata", {}).get("Version", "UNKNOWN"),
-                    "modules": data.get("top_level", []),
-                    "alias": _reqs_name if _reqs_name != pkg else ""
-                }
-                pkgs_info.append(_pkg)
+            pkgs_info = [self._pkg_info(pkg, data) for pkg, data in self._pkgs_map.items()]
 
         if self._fmt == "json":
-            response = json.dumps(pkgs_info)
-        else:
-            response = pkgs_info
-        return response
+            # orjson is optional, but much faster to serialize
+            if orjson is not None:
+                return orjson.dumps(pkgs_info).decode()
+            return json.dumps(pkgs_info, separators=(",", ":"), ensure_ascii=False)
+        return pkgs_info
 
     def map(self) -> any:
         """
@@ -244,14 +517,60 @@ class Mapper:
                 refinitiv-dataplatform
         :return:
         """
-        self._cmd(["pip", "install", "--upgrade", "pip"])
-        reqs_lines = self._read(self._regs)
+        try:
+            reqs_lines = self._read(self._regs)
+        except FileNotFoundError as e:
+            self.log.error(e)
+            raise
         reqs_dict = self._split(reqs_lines)
+        raws = [f"{name}=={version}" for name, version in reqs_dict.items()]
+
+        cached = self._load_cache()
+        if all(raw in cached for raw in raws):
+            # all requirements are installed already and nothing changed since the last run
+            self.log.debug("Use cached packages data: %s", self._cache_path)
+            self._pkgs_map = dict(cached[raw] for raw in raws)
+            return self._format()
+
+        self._site_index = self._index_site_pkgs()
+        # skip pip for the packages which are installed already with the same version
+        specs = [f"{name}=={version}" for name, version in reqs_dict.items() if not self._get_pkg_path(name, version)]
+        failed = set()
+        if specs:
+            # pip imported in-process by a previous run must not be upgraded under itself
+            if "pip._internal" not in sys.modules:
+                self._cmd([*_PIP, "install", "--upgrade", "pip"])
+            failed = self._install(specs)
+            self._site_index = self._index_site_pkgs()
+        # todo handle error
+        installed, missing = [], []
         for name, version in reqs_dict.items():
-            _, err = self._install(name, version)
-            if err:
-                self.log.error(f"Problem to install {name}:{version}. Error: {err}")
-                # todo handle error
-                continue
-            self._add_pkg_data(name, version)
+            if _canonicalize_name(name) not in failed:
+                (installed if self._get_pkg_path(name, version) else missing).append((name, version))
+        if installed:
+            # reading packages metadata is I/O bound, so threads are enough here
+            with ThreadPoolExecutor(max_workers=min(32, len(installed))) as executor:
+                list(executor.map(lambda pkg: self._add_pkg_data(*pkg), installed))
+        # packages outside of site-packages
+        missing = [(name, version) for name, version in missing if not self._add_dist_data(name, version)]
+        if missing:
+            shown = self._batch_show([_canonicalize_name(name) for name, _ in missing])
+            for name, version in missing:
+                _pkg_meta = shown.get(_canonicalize_name(name))
+                if _pkg_meta is None:
+                    self.log.error("Package dir not found for %s:%s", name, version)
+                    continue
+                if _pkg_meta.get("Version") != version:
+                    self.log.error("Package %s:%s not installed, found version: %s", name, version,
+                                   _pkg_meta.get("Version"))
+                    continue
+                self.log.warning("pip show has no top level modules for %s:%s, modules are unknown", name, version)
+                self._set_pkg_data(name, version, _pkg_meta, None)
+        # packages found outside of site-packages are not cached, the cache key does not track their changes
+        indexed = {f"{name}=={version}" for name, version in installed}
+        self._save_cache({
+            data["requirements"]["raw"]: [pkg, data]
+            for pkg, data in self._pkgs_map.items()
+            if data["requirements"]["raw"] in indexed
+        })
         return self._format()
@@ -1,4 +1,11 @@
+import os
+import sys
+import tempfile
 import unittest
+from unittest import mock
+
+from pipmap import Mapper
+from pipmap.mapper import _NOT_FOUND_RE, _canonicalize_name
 
 
 class TestMapper(unittest.TestCase):
@@ -6,6 +13,220 @@ class TestMapper(unittest.TestCase):
     def test_upper(self):
         self.assertEqual('foo'.upper(), 'FOO')
 
+    def test_split(self):
+        lines = ["numpy==1.18.1\n", " pandas == 1.0.1  # comment", "# requests==2.23.0", "requests[security]==2.0",
+                 "six>=1.0", ""]
+        with self.assertLogs("pipmap", level="WARNING") as logs:
+            reqs = Mapper(cache=False)._split(lines)
+        self.assertEqual(reqs, {"numpy": "1.18.1", "pandas": "1.0.1", "requests[security]": "2.0"})
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("six>=1.0", logs.output[0])
+
+    def test_canonicalize_name(self):
+        self.assertEqual(_canonicalize_name("refinitiv_dataplatform"), "refinitiv-dataplatform")
+        self.assertEqual(_canonicalize_name("Foo.Bar__baz"), "foo-bar-baz")
+        self.assertEqual(_canonicalize_name("requests[security]"), "requests")
+
+    def test_not_found_re(self):
+        err = ("ERROR: Could not find a version that satisfies the requirement six==0.0.1 (from versions: 1.14.0)\n"
+               "ERROR: No matching distribution found for six==0.0.1\n"
+               "ERROR: No matching distribution found for refinitiv_dataplatform==1.0.0a0\n")
+        self.assertEqual(set(_NOT_FOUND_RE.findall(err)), {"six", "refinitiv_dataplatform"})
+
+    def test_install_retries_without_not_found(self):
+        err = ("ERROR: Could not find a version that satisfies the requirement Six==0.0.1 (from versions: 1.14.0)\n"
+               "ERROR: No matching distribution found for Six==0.0.1\n")
+        with mock.patch.object(Mapper, "_pip", side_effect=[(1, err), (0, "")]) as pip:
+            failed = Mapper(cache=False)._install(["Six==0.0.1", "idna==2.9"])
+        self.assertEqual(failed, {"six"})
+        self.assertEqual(pip.call_args_list, [mock.call(["install", "Six==0.0.1", "idna==2.9"]),
+                                              mock.call(["install", "idna==2.9"])])
+
+    def test_install_logs_other_errors(self):
+        with mock.patch.object(Mapper, "_pip", return_value=(1, "ERROR: Failed building wheel for six\n")) as pip:
+            with self.assertLogs("pipmap", level="ERROR") as logs:
+                failed = Mapper(cache=False)._install(["six==1.14.0"])
+        self.assertEqual(failed, set())
+        pip.assert_called_once_with(["install", "six==1.14.0"])
+        self.assertIn("Failed building wheel for six", logs.output[0])
+
+    def test_get_pkg_path(self):
+        with tempfile.TemporaryDirectory() as site_pkgs:
+            for name in ["refinitiv_dataplatform-1.0.0a0.dist-info", "six-1.14.0-py3.8.egg-info", "six"]:
+                os.mkdir(os.path.join(site_pkgs, name))
+            mapper = Mapper(cache=False)
+            mapper._site_pkgs = site_pkgs
+            mapper._site_index = mapper._index_site_pkgs()
+            self.assertEqual(mapper._get_pkg_path("refinitiv-dataplatform", "1.0.0a0"),
+                             os.path.join(site_pkgs, "refinitiv_dataplatform-1.0.0a0.dist-info"))
+            self.assertEqual(mapper._get_pkg_path("Six", "1.14.0"),
+                             os.path.join(site_pkgs, "six-1.14.0-py3.8.egg-info"))
+            self.assertIsNone(mapper._get_pkg_path("six", "1.15.0"))
+
+    def test_get_pkg_meta(self):
+        with tempfile.TemporaryDirectory() as location:
+            with open(os.path.join(location, "METADATA"), "w", encoding="utf-8") as fout:
+                fout.write("Metadata-Version: 2.1\nName: six\nVersion: 1.14.0\nSummary: Python 2 and 3\n"
+                           "  compatibility utilities\nAuthor: Sébastien\n\n"
+                           "Six: Python 2 and 3 Compatibility Library\n")
+            meta = Mapper(cache=False)._get_pkg_meta(location)
+        self.assertEqual(meta["Name"], "six")
+        self.assertEqual(meta["Version"], "1.14.0")
+        self.assertEqual(meta["Summary"], "Python 2 and 3\n  compatibility utilities")
+        self.assertEqual(meta["Author"], "Sébastien")
+        self.assertNotIn("Six", meta)
+
+    def test_batch_show(self):
+        stdout = ("Name: six\nVersion: 1.14.0\nSummary: Python 2 and 3 compatibility utilities\n---\n"
+                  "Name: refinitiv-dataplatform\nVersion: 1.0.0a0\nRequires: deprecation\n")
+        with mock.patch.object(Mapper, "_cmd", return_value=(stdout, "")) as cmd:
+            metas = Mapper(cache=False)._batch_show(["six", "refinitiv_dataplatform"])
+        cmd.assert_called_once_with([sys.executable, "-m", "pip", "show", "six", "refinitiv_dataplatform"])
+        self.assertEqual(sorted(metas), ["refinitiv-dataplatform", "six"])
+        self.assertEqual(metas["six"]["Version"], "1.14.0")
+        self.assertEqual(metas["refinitiv-dataplatform"]["Requires"], "deprecation")
+
+    def test_format_json(self):
+        mapper = Mapper(cache=False)
+        mapper._set_pkg_data("six", "1.14.0", {"Name": "six", "Version": "1.14.0", "Author": "Sébastien"}, ["six"])
+        expected = '[{"name":"six","version":"1.14.0","modules":["six"],"alias":""}]'
+        self.assertEqual(mapper._format(), expected)
+        with mock.patch("pipmap.mapper.orjson", None):
+            self.assertEqual(mapper._format(), expected)
+
+    def _cache_mapper(self, site_pkgs: str, cache_dir: str) -> Mapper:
+        mapper = Mapper(reqs=os.path.join(cache_dir, "requirements.txt"))
+        mapper._site_pkgs = site_pkgs
+        mapper._cache_path = os.path.join(cache_dir, "pipmap", "meta.json")
+        return mapper
+
+    def test_cache(self):
+        six = ["six", {"metadata": {"Name": "six", "Version": "1.14.0"},
+                       "requirements": {"name": "six", "version": "1.14.0", "raw": "six==1.14.0"},
+                       "top_level": ["six"]}]
+        idna = ["idna", {"metadata": {"Name": "idna", "Version": "2.9"},
+                         "requirements": {"name": "idna", "version": "2.9", "raw": "idna==2.9"},
+                         "top_level": ["idna"]}]
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as cache_dir:
+            mapper = self._cache_mapper(site_pkgs, cache_dir)
+            self.assertEqual(mapper._load_cache(), {})
+            mapper._save_cache({"six==1.14.0": six})
+            self.assertEqual(mapper._load_cache(), {"six==1.14.0": six})
+            # entries for the same site-packages state are merged
+            mapper._save_cache({"idna==2.9": idna})
+            self.assertEqual(mapper._load_cache(), {"six==1.14.0": six, "idna==2.9": idna})
+            # any site-packages change makes the cache outdated
+            os.utime(site_pkgs, ns=(0, 0))
+            self.assertEqual(mapper._load_cache(), {})
+            mapper._save_cache({"idna==2.9": idna})
+            self.assertEqual(mapper._load_cache(), {"idna==2.9": idna})
+
+    def test_cache_per_environment(self):
+        with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as site_a, \
+                tempfile.TemporaryDirectory() as site_b, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_dir}):
+            mappers = []
+            for site_pkgs in (site_a, site_b):
+                with mock.patch("pipmap.mapper._SITE_PKGS", site_pkgs):
+                    mappers.append(Mapper())
+            mapper_a, mapper_b = mappers
+            self.assertNotEqual(mapper_a._cache_path, mapper_b._cache_path)
+            mapper_a._save_cache({"six==1.14.0": ["six", {}]})
+            mapper_b._save_cache({"idna==2.9": ["idna", {}]})
+            self.assertEqual(mapper_a._load_cache(), {"six==1.14.0": ["six", {}]})
+            self.assertEqual(mapper_b._load_cache(), {"idna==2.9": ["idna", {}]})
+
+    def test_save_cache_not_serializable(self):
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as cache_dir:
+            mapper = self._cache_mapper(site_pkgs, cache_dir)
+            with self.assertLogs("pipmap", level="WARNING"):
+                mapper._save_cache({"six==1.14.0": ["six", {"metadata": object()}]})
+            self.assertFalse(os.path.exists(os.path.dirname(mapper._cache_path)))
+
+    def test_map_from_cache(self):
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as cache_dir:
+            mapper = self._cache_mapper(site_pkgs, cache_dir)
+            with open(mapper._regs, "w") as fout:
+                fout.write("six==1.14.0\n")
+            mapper._save_cache({"six==1.14.0": [
+                "six", {"metadata": {"Name": "six", "Version": "1.14.0"},
+                        "requirements": {"name": "six", "version": "1.14.0", "raw": "six==1.14.0"},
+                        "top_level": ["six"]}
+            ]})
+            with mock.patch.object(Mapper, "_cmd") as cmd, mock.patch.object(Mapper, "_index_site_pkgs") as index:
+                result = mapper.map()
+            cmd.assert_not_called()
+            index.assert_not_called()
+        self.assertEqual(result, '[{"name":"six","version":"1.14.0","modules":["six"],"alias":""}]')
+
+    def test_map_from_pip_show_not_cached(self):
+        show = "Name: six\nVersion: 1.14.0\nSummary: Python 2 and 3 compatibility utilities\n"
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as cache_dir:
+            mapper = self._cache_mapper(site_pkgs, cache_dir)
+            with open(mapper._regs, "w") as fout:
+                fout.write("six==1.14.0\n")
+            with mock.patch.object(sys, "path", []), mock.patch.object(Mapper, "_pip", return_value=(0, "")), \
+                    mock.patch.object(Mapper, "_cmd", return_value=(show, "")):
+                with self.assertLogs("pipmap", level="WARNING") as logs:
+                    result = mapper.map()
+            self.assertEqual(mapper._load_cache(), {})
+        self.assertEqual(result, '[{"name":"six","version":"1.14.0","modules":[],"alias":""}]')
+        self.assertIn("modules are unknown", logs.output[-1])
+
+    def _site_mapper(self, site_pkgs: str, reqs_dir: str, reqs: str) -> Mapper:
+        dist_info = os.path.join(site_pkgs, "six-1.14.0.dist-info")
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as fout:
+            fout.write("Metadata-Version: 2.1\nName: six\nVersion: 1.14.0\n")
+        with open(os.path.join(dist_info, "top_level.txt"), "w") as fout:
+            fout.write("six\n")
+        mapper = Mapper(reqs=os.path.join(reqs_dir, "requirements.txt"), cache=False)
+        mapper._site_pkgs = site_pkgs
+        with open(mapper._regs, "w") as fout:
+            fout.write(reqs)
+        return mapper
+
+    def test_map_skips_installed(self):
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as reqs_dir:
+            mapper = self._site_mapper(site_pkgs, reqs_dir, "six==1.14.0\n")
+            with mock.patch.object(Mapper, "_pip") as pip, mock.patch.object(Mapper, "_cmd") as cmd:
+                result = mapper.map()
+        pip.assert_not_called()
+        cmd.assert_not_called()
+        self.assertEqual(result, '[{"name":"six","version":"1.14.0","modules":["six"],"alias":""}]')
+
+    def test_map_installs_missing(self):
+        err = "ERROR: No matching distribution found for badpkg==0.1\n"
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as reqs_dir:
+            mapper = self._site_mapper(site_pkgs, reqs_dir, "six==1.14.0\nidna==2.9\nbadpkg==0.1\n")
+            with mock.patch.dict(sys.modules), mock.patch.object(sys, "path", []), \
+                    mock.patch.object(Mapper, "_pip", side_effect=[(1, err), (0, "")]) as pip, \
+                    mock.patch.object(Mapper, "_cmd", return_value=("", "")) as cmd, \
+                    self.assertLogs("pipmap", level="ERROR"):
+                sys.modules.pop("pip._internal", None)
+                result = mapper.map()
+        self.assertEqual(pip.call_args_list, [mock.call(["install", "idna==2.9", "badpkg==0.1"]),
+                                              mock.call(["install", "idna==2.9"])])
+        self.assertEqual(cmd.call_args_list, [mock.call([sys.executable, "-m", "pip", "install", "--upgrade", "pip"]),
+                                              mock.call([sys.executable, "-m", "pip", "show", "idna"])])
+        self.assertEqual(result, '[{"name":"six","version":"1.14.0","modules":["six"],"alias":""}]')
+
+    def test_map_from_other_sys_path(self):
+        with tempfile.TemporaryDirectory() as site_pkgs, tempfile.TemporaryDirectory() as user_site, \
+                tempfile.TemporaryDirectory() as reqs_dir:
+            mapper = self._site_mapper(site_pkgs, reqs_dir, "idna==2.9\n")
+            dist_info = os.path.join(user_site, "idna-2.9.dist-info")
+            os.mkdir(dist_info)
+            with open(os.path.join(dist_info, "METADATA"), "w") as fout:
+                fout.write("Metadata-Version: 2.1\nName: idna\nVersion: 2.9\n")
+            with open(os.path.join(dist_info, "top_level.txt"), "w") as fout:
+                fout.write("idna\n")
+            with mock.patch.object(sys, "path", [user_site]), \
+                    mock.patch.object(Mapper, "_pip", return_value=(0, "")), \
+                    mock.patch.object(Mapper, "_cmd", return_value=("", "")) as cmd:
+                result = mapper.map()
+        self.assertNotIn("show", [arg for call in cmd.call_args_list for arg in call.args[0]])
+        self.assertEqual(result, '[{"name":"idna","version":"2.9","modules":["idna"],"alias":""}]')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -28,7 +28,8 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    install_requires=[],
+    install_requires=['importlib_metadata; python_version < "3.8"'],
+    extras_require={"orjson": ["orjson"]},
     include_package_data=True,
     python_requires='>=3.6',
     test_suite="setup.test_suite"